@@ -3,21 +3,52 @@ import subprocess
 import re
 import os
 import warnings
+import multiprocessing
+from array import array
+from collections import deque
+from functools import partial
+from itertools import islice
+from concurrent.futures import (ThreadPoolExecutor, ProcessPoolExecutor,
+                                as_completed)
 from tempfile import mkdtemp
 from shutil import rmtree
 from distutils.spawn import find_executable
 from tempfile import gettempdir
 
+import numpy as np
 from six import string_types
 
+try:
+    import vina
+except ImportError:
+    vina = None
+
+# drop-in, faster replacement of float() for parsing scores
+try:
+    from fastnumbers import float as _fast_float
+except ImportError:
+    _fast_float = float
+
 import oddt
 from oddt.utils import (is_openbabel_molecule,
                         is_molecule,
                         check_molecule)
-from oddt.spatial import rmsd
+
+# maximum number of ligand files passed to single Vina run, which keeps the
+# command line well below ARG_MAX
+MAX_BATCH_SIZE = 200
+
+# scores of docked poses, as returned by parse_vina_docking_output(as_array=True)
+VINA_DOCKING_DTYPE = np.dtype([('vina_affinity', np.float32),
+                               ('vina_rmsd_lb', np.float32),
+                               ('vina_rmsd_ub', np.float32)])
 
 
 class autodock_vina(object):
+    # executable paths and versions detected so far, shared by all instances
+    _exe_cache = {}
+    _version_cache = {}
+
     def __init__(self,
                  protein=None,
                  auto_ligand=None,
@@ -29,9 +60,15 @@ class autodock_vina(object):
                  seed=None,
                  prefix_dir=None,
                  n_cpu=1,
+                 n_jobs=-1,
                  executable=None,
                  autocleanup=True,
-                 skip_bad_mols=True):
+                 skip_bad_mols=True,
+                 use_python_api=False,
+                 use_maps=False,
+                 ligand_dir_strategy='per_call',
+                 batch_size=64,
+                 parallel_write=False):
         """Autodock Vina docking engine, which extends it's capabilities:
         automatic box (auto-centering on ligand).
         Other software compatible with Vina API can also be used (e.g. QuickVina).
@@ -70,6 +107,17 @@ class autodock_vina(object):
             By default (None) system temporary directory is used,
             for reference see `tempfile.gettempdir`.
 
+        n_cpu: int (default=1)
+            Number of CPUs used by each Autodock Vina process. By default
+            multiple ligands are processed concurrently, as many at once as
+            there are CPUs available to the process (respecting its CPU
+            affinity) divided by `n_cpu`, see `n_jobs`.
+
+        n_jobs: int (default=-1)
+            Maximum number of concurrent Autodock Vina processes. If -1, it is
+            limited only by available CPUs (see `n_cpu`). Use 1 to process
+            ligands one by one.
+
         executable: string or None (default=None)
             Autodock Vina executable location in the system.
             It's really necessary if autodetection fails.
@@ -79,6 +127,43 @@ class autodock_vina(object):
 
         skip_bad_mols: bool (default=True)
             Should molecules that crash Autodock Vina be skipped.
+
+        use_python_api: bool (default=False)
+            Dock using Autodock Vina (1.2+) Python bindings. The receptor and
+            grid maps are then computed once and reused for all ligands,
+            instead of spawning Vina process per ligand. Scoring still uses
+            the executable, which is otherwise optional. If bindings are not
+            installed the executable is used as a fallback.
+
+        use_maps: bool (default=False)
+            Precompute receptor grid maps once per protein and dock using
+            them (requires Autodock Vina 1.2+), instead of recalculating them
+            in every Vina run. Maps are written with limited precision, hence
+            affinities differ slightly from docking to the receptor directly.
+
+        ligand_dir_strategy: string (default='per_call')
+            Where ligand files are written during scoring and docking:
+                - per_call - new temporary directory for each call
+                - shared - single directory reused by all calls, only the
+                  ligand files are removed afterwards. File names
+                  (`<n>_<title>.pdbqt`) collide within a process, so it is
+                  unsafe to call `dock`/`score` of the same instance from
+                  multiple threads concurrently
+                - tmpfs - new directory in memory backed `/dev/shm` (if
+                  available) for each call, so files never hit the disk
+                  (`prefix_dir` is not used for ligand files then)
+
+        batch_size: int (default=64)
+            Number of ligands docked by a single Autodock Vina (1.2+) run,
+            using its `--batch` mode (at most 200). Set to 1 to run Vina
+            for each ligand separately.
+
+        parallel_write: bool (default=False)
+            Write ligand PDBQT files in separate processes, as many as there
+            are concurrent Vina runs (see `n_jobs`). Pays off only for large
+            sets of ligands which are cheap to pickle. On platforms spawning
+            processes (Windows, macOS) the calling script has to be guarded
+            with `if __name__ == '__main__':`.
         """
         self.dir = prefix_dir or gettempdir()
         self._tmp_dir = None
@@ -90,41 +175,79 @@ class autodock_vina(object):
             if isinstance(auto_ligand, string_types):
                 extension = auto_ligand.split('.')[-1]
                 auto_ligand = next(oddt.toolkit.readfile(extension, auto_ligand))
-            self.center = auto_ligand.coords.mean(axis=0).round(3)
+            # plain floats are formatted cheaply and cleanly in Vina parameters
+            center = np.asarray(auto_ligand.coords).mean(axis=0)
+            self.center = tuple(round(float(c), 3) for c in center)
+        # Vina Python bindings
+        self.use_python_api = use_python_api
+        if self.use_python_api and vina is None:
+            warnings.warn('Autodock Vina Python bindings could not be imported, '
+                          'falling back to Vina executable.')
+            self.use_python_api = False
+        self._vina = None
+
         # autodetect Vina executable
         if not executable:
-            self.executable = find_executable('vina')
+            if 'vina' not in autodock_vina._exe_cache:
+                autodock_vina._exe_cache['vina'] = find_executable('vina')
+            self.executable = autodock_vina._exe_cache['vina']
             if not self.executable:
-                raise Exception('Could not find Autodock Vina binary.'
-                                'You have to install it globally or supply binary'
-                                'full directory via `executable` parameter.')
+                del autodock_vina._exe_cache['vina']
+                # bindings dock without the binary, it is needed for scoring
+                if not self.use_python_api:
+                    raise Exception('Could not find Autodock Vina binary.'
+                                    'You have to install it globally or supply binary'
+                                    'full directory via `executable` parameter.')
         else:
             self.executable = executable
         # detect version
-        self.version = (subprocess.check_output([self.executable, '--version'])
-                        .decode('ascii').split(' ')[2])
+        if not self.executable:
+            self.version = vina.__version__
+            self._vina12 = False
+        else:
+            if self.executable not in autodock_vina._version_cache:
+                autodock_vina._version_cache[self.executable] = (
+                    subprocess.check_output([self.executable, '--version'])
+                    .decode('ascii').strip())
+            version_output = autodock_vina._version_cache[self.executable]
+            self.version = version_output.split(' ')[2]
+            # options added in Autodock Vina 1.2 (grid maps, batch docking)
+            # are used only with Vina itself, not with compatible software
+            self._vina12 = (version_output.startswith('AutoDock Vina') and
+                            _version_tuple(self.version) >= (1, 2))
+        self._batch_warned = False
         self.autocleanup = autocleanup
         self.cleanup_dirs = set()
+        self.use_maps = use_maps
 
         # share protein to class
         self.protein = None
         self.protein_file = None
+        self.maps_prefix = None
+        self._protein_key = None
+        self._protein_dir = None
         if protein:
             self.set_protein(protein)
         self.skip_bad_mols = skip_bad_mols
+        if ligand_dir_strategy not in ('per_call', 'shared', 'tmpfs'):
+            raise ValueError('Unknown ligand directory strategy "%s"'
+                             % ligand_dir_strategy)
+        self.ligand_dir_strategy = ligand_dir_strategy
+        self.batch_size = min(batch_size, MAX_BATCH_SIZE)
+        self.parallel_write = parallel_write
         self.n_cpu = n_cpu
+        self.n_jobs = n_jobs
         if self.n_cpu > exhaustiveness:
             warnings.warn('Exhaustiveness is lower than n_cpus, thus CPU will '
                           'not be saturated.')
 
+        self.exhaustiveness = exhaustiveness
+        self.num_modes = num_modes
+        self.energy_range = energy_range
+        self.seed = seed
+
         # pregenerate common Vina parameters
-        self.params = []
-        self.params += ['--center_x', str(self.center[0]),
-                        '--center_y', str(self.center[1]),
-                        '--center_z', str(self.center[2])]
-        self.params += ['--size_x', str(self.size[0]),
-                        '--size_y', str(self.size[1]),
-                        '--size_z', str(self.size[2])]
+        self.params = self._box_params()
         self.params += ['--exhaustiveness', str(exhaustiveness)]
         if seed is not None:
             self.params += ['--seed', str(seed)]
@@ -136,6 +259,8 @@ class autodock_vina(object):
 
     @property
     def tmp_dir(self):
+        # single directory is created on first use and kept for the lifetime
+        # of an instance
         if not self._tmp_dir:
             self._tmp_dir = mkdtemp(dir=self.dir, prefix='autodock_vina_')
             self.cleanup_dirs.add(self._tmp_dir)
@@ -153,9 +278,20 @@ class autodock_vina(object):
         protein: oddt.toolkit.Molecule object
             Protein object to be used.
         """
-        # generate new directory
-        self._tmp_dir = None
         if protein:
+            # setting the same, unchanged protein again is a no-op
+            key = _protein_key(protein)
+            if key == self._protein_key:
+                return
+
+        # receptor and maps in Vina bindings have to be recomputed
+        self._vina = None
+        if protein:
+            # each protein gets its own subdirectory of the persistent
+            # temporary directory, which holds only files written by engine
+            # (user supplied PDBQT files are used in place)
+            protein_dir = mkdtemp(dir=self.tmp_dir, prefix='protein_')
+            self.protein_file = None
             if isinstance(protein, string_types):
                 extension = protein.split('.')[-1]
                 if extension == 'pdbqt':
@@ -170,8 +306,52 @@ class autodock_vina(object):
 
             # skip writing if we have PDBQT protein
             if self.protein_file is None:
-                self.protein_file = write_vina_pdbqt(self.protein, self.tmp_dir,
+                self.protein_file = write_vina_pdbqt(self.protein, protein_dir,
                                                      flexible=False)
+            self.maps_prefix = self._write_maps(protein_dir)
+            self._protein_key = key
+            # files of previous protein are not used anymore
+            if self._protein_dir:
+                rmtree(self._protein_dir, ignore_errors=True)
+            self._protein_dir = protein_dir
+
+    def _write_maps(self, directory):
+        """Precompute receptor grid maps once, so that they are reused for all
+        ligands instead of being recalculated by every Vina run. Requires
+        Autodock Vina 1.2+, returns maps prefix or None if not supported or
+        not requested. Python bindings compute their own maps, so none are
+        written then."""
+        if not self.use_maps or self.use_python_api or not self._vina12:
+            return None
+        maps_prefix = os.path.join(directory, 'maps')
+        try:
+            subprocess.check_output([self.executable,
+                                     '--receptor', self.protein_file,
+                                     '--write_maps', maps_prefix] +
+                                    self._box_params(),
+                                    stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError as e:
+            warnings.warn('Autodock Vina could not write grid maps, receptor '
+                          'will be used directly: %s' % e.output.decode('ascii'))
+            return None
+        return maps_prefix
+
+    def _box_params(self):
+        """Vina parameters defining docking box"""
+        return ['--center_x', str(self.center[0]),
+                '--center_y', str(self.center[1]),
+                '--center_z', str(self.center[2]),
+                '--size_x', str(self.size[0]),
+                '--size_y', str(self.size[1]),
+                '--size_z', str(self.size[2])]
+
+    @property
+    def receptor_params(self):
+        """Vina parameters pointing to receptor for docking, precomputed
+        maps are used if requested (see `use_maps`)"""
+        if self.maps_prefix:
+            return ['--maps', self.maps_prefix]
+        return ['--receptor', self.protein_file]
 
     def score(self, ligands, protein=None):
         """Automated scoring procedure.
@@ -194,32 +374,33 @@ class autodock_vina(object):
             self.set_protein(protein)
         if not self.protein_file:
             raise IOError("No receptor.")
+        if not self.executable:
+            raise Exception('Autodock Vina binary is required for scoring.')
         if is_molecule(ligands):
             ligands = [ligands]
-        ligand_dir = mkdtemp(dir=self.tmp_dir, prefix='ligands_')
+        ligands = list(ligands)
+        ligand_dir = self._make_ligand_dir()
+        ligand_files = []
+        try:
+            ligand_files = self._write_ligands(ligands, ligand_dir)
+            # maps are stored with limited precision, hence they are not used
+            # for scoring, where grid computation is not the bottleneck anyway
+            results = self._run_parallel(_score_one, ligand_files,
+                                         ['--receptor', self.protein_file],
+                                         self.params)
+        finally:
+            self._clean_ligand_dir(ligand_dir, ligand_files)
+
         output_array = []
-        for n, ligand in enumerate(ligands):
-            check_molecule(ligand, force_coords=True)
-            ligand_file = write_vina_pdbqt(ligand, ligand_dir, name_id=n)
-            try:
-                scores = parse_vina_scoring_output(
-                    subprocess.check_output([self.executable, '--score_only',
-                                             '--receptor', self.protein_file,
-                                             '--ligand', ligand_file] + self.params,
-                                            stderr=subprocess.STDOUT))
-            except subprocess.CalledProcessError as e:
-                sys.stderr.write(e.output.decode('ascii'))
-                if self.skip_bad_mols:
-                    continue
-                else:
-                    raise Exception('Autodock Vina failed. Command: "%s"' %
-                                    ' '.join(e.cmd))
+        output_append = output_array.append
+        for ligand, scores in zip(ligands, results):
+            if scores is None:
+                continue
             ligand.data.update(scores)
-            output_array.append(ligand)
-        rmtree(ligand_dir)
+            output_append(ligand)
         return output_array
 
-    def dock(self, ligands, protein=None):
+    def dock(self, ligands, protein=None, poses=True):
         """Automated docking procedure.
 
         Parameters
@@ -231,10 +412,22 @@ class autodock_vina(object):
             Protein object to be used. If None, then the default one
             is used, else the protein is new default.
 
+        poses: bool (default=True)
+            If False, docked poses are not built and only their scores are
+            returned, which is much lighter when aggregating results of
+            large screens.
+
         Returns
         -------
         ligands : array of oddt.toolkit.Molecule objects
             Array of ligands (scores are stored in mol.data method)
+
+        or if `poses` is False
+
+        scores : numpy.ndarray
+            Structured array of scores of all docked poses, with `ligand`
+            field holding index of docked ligand and `vina_affinity`,
+            `vina_rmsd_lb` and `vina_rmsd_ub` fields.
         """
         if protein:
             self.set_protein(protein)
@@ -242,67 +435,250 @@ class autodock_vina(object):
             raise IOError("No receptor.")
         if is_molecule(ligands):
             ligands = [ligands]
-        ligand_dir = mkdtemp(dir=self.tmp_dir, prefix='ligands_')
+        ligands = list(ligands)
+        ligand_dir = self._make_ligand_dir()
+        ligand_files = []
+        try:
+            ligand_files = self._write_ligands(ligands, ligand_dir)
+            if self.use_python_api:
+                results = [self._dock_python_api(ligand_file, as_array=not poses)
+                           for ligand_file in ligand_files]
+            elif self.batch_size > 1 and self._vina12:
+                results = self._dock_batches(ligand_files, ligand_dir,
+                                             as_array=not poses)
+            else:
+                results = self._run_parallel(partial(_dock_one, as_array=not poses),
+                                             ligand_files,
+                                             self.receptor_params,
+                                             self.params + ['--cpu', str(self.n_cpu)])
+            if not poses:
+                return _stack_docking_scores(results)
+            return self._docked_poses(ligands, ligand_files, results)
+        finally:
+            self._clean_ligand_dir(ligand_dir, ligand_files)
+
+    def _docked_poses(self, ligands, ligand_files, results):
+        """Copy coordinates of docked poses onto clones of input ligands and
+        annotate them with scores and RMSD to the input pose."""
+        # bind names used in the loops below to locals, to skip global and
+        # attribute lookups for every pose
         output_array = []
-        for n, ligand in enumerate(ligands):
-            check_molecule(ligand, force_coords=True)
-            ligand_file = write_vina_pdbqt(ligand, ligand_dir, name_id=n)
-            ligand_outfile = ligand_file[:-6] + '_out.pdbqt'
+        output_append = output_array.append
+        np_abs = np.abs
+        float32 = np.float32
+        rmsd_input_func = _rmsd_input
+        read_coords = read_vina_pdbqt_coords
+        for ligand, ligand_file, result in zip(ligands, ligand_files, results):
+            if result is None:
+                continue  # TODO: print some warning message
+            ligand_outfile, scores = result
+
+            # docked conformations may have wrong connectivity - use source
+            # ligand and copy coordinates of docked poses onto it
+            # find the order of PDBQT atoms, serials hold original atom indices
+            with open(ligand_file, 'rb') as f:
+                write_order = [int(line[7:12])
+                               for line in f.read().split(b'\n')
+                               if line[:4] == b'ATOM']
+            write_order = np.array(write_order, dtype=np.int32)
+            new_order = np.argsort(write_order, kind='stable')
+
+            assert len(new_order) == len(ligand.atoms)
+
+            heavy = None
             try:
-                scores = parse_vina_docking_output(
-                    subprocess.check_output([self.executable, '--receptor',
-                                             self.protein_file,
-                                             '--ligand', ligand_file,
-                                             '--out', ligand_outfile] +
-                                            self.params +
-                                            ['--cpu', str(self.n_cpu)],
-                                            stderr=subprocess.STDOUT))
-            except subprocess.CalledProcessError as e:
-                sys.stderr.write(e.output.decode('ascii'))
-                if self.skip_bad_mols:
-                    continue  # TODO: print some warning message
-                else:
-                    raise Exception('Autodock Vina failed. Command: "%s"' %
-                                    ' '.join(e.cmd))
-
-            # docked conformations may have wrong connectivity - use source ligand
-            if is_openbabel_molecule(ligand):
-                # find the order of PDBQT atoms assigned by OpenBabel
-                with open(ligand_file) as f:
-                    write_order = [int(line[7:12].strip())
-                                   for line in f
-                                   if line[:4] == 'ATOM']
-                new_order = sorted(range(len(write_order)),
-                                   key=write_order.__getitem__)
-                new_order = [i + 1 for i in new_order]  # OBMol has 1 based idx
-
-                assert len(new_order) == len(ligand.atoms)
-
-            docked_ligands = oddt.toolkit.readfile('pdbqt', ligand_outfile)
-            for docked_ligand, score in zip(docked_ligands, scores):
-                # Renumber atoms to match the input ligand
-                if is_openbabel_molecule(docked_ligand):
-                    docked_ligand.OBMol.RenumberAtoms(new_order)
-                # HACK: copy docked coordinates onto source ligand
-                # We assume that the order of atoms match between ligands
+                heavy = ligand.atom_dict['atomicnum'] != 1
+                ligand_coords = ligand.coords
+                ref_coords = ligand_coords[heavy]
+            except Exception:
+                pass
+            # symmetry matches depend only on topology which is shared by all
+            # poses, hence they are searched once per ligand when first needed
+            matches = None
+            matches_searched = False
+
+            for pose_coords, score in zip(read_coords(ligand_outfile), scores):
+                pose_coords = pose_coords[new_order].astype(float32)
                 clone = ligand.clone
-                clone.clone_coords(docked_ligand)
+                clone.coords = pose_coords
                 clone.data.update(score)
 
                 # Calculate RMSD to the input pose
-                try:
-                    clone.data['vina_rmsd_input'] = rmsd(ligand, clone)
-                    clone.data['vina_rmsd_input_min'] = rmsd(ligand, clone,
-                                                             method='min_symmetry')
-                except Exception:
-                    pass
-                output_array.append(clone)
-        rmtree(ligand_dir)
+                if heavy is not None:
+                    # skip RMSD (and symmetry) computation for poses matching
+                    # the input up to the precision of PDBQT coordinates
+                    if np_abs(pose_coords - ligand_coords).max() < 1e-3:
+                        rmsd_input = rmsd_input_min = 0.
+                    else:
+                        if not matches_searched:
+                            matches_searched = True
+                            try:
+                                matches = _symmetry_matches(ligand, heavy)
+                            except Exception:
+                                pass
+                        rmsd_input, rmsd_input_min = rmsd_input_func(
+                            ref_coords, pose_coords, heavy, matches)
+                    clone.data['vina_rmsd_input'] = rmsd_input
+                    if rmsd_input_min is not None:
+                        clone.data['vina_rmsd_input_min'] = rmsd_input_min
+                output_append(clone)
         return output_array
 
+    def _make_ligand_dir(self):
+        """Get directory for ligand files according to `ligand_dir_strategy`"""
+        if self.ligand_dir_strategy == 'shared':
+            # separate directories for processes sharing this instance
+            ligand_dir = os.path.join(self.tmp_dir, 'ligands_%i' % os.getpid())
+            if not os.path.isdir(ligand_dir):
+                os.makedirs(ligand_dir)
+            return ligand_dir
+        elif self.ligand_dir_strategy == 'tmpfs' and os.path.isdir('/dev/shm'):
+            return mkdtemp(dir='/dev/shm', prefix='autodock_vina_ligands_')
+        return mkdtemp(dir=self.tmp_dir, prefix='ligands_')
+
+    def _clean_ligand_dir(self, ligand_dir, ligand_files):
+        """Remove ligand files or the whole directory if it is not shared"""
+        if self.ligand_dir_strategy == 'shared':
+            for ligand_file in ligand_files:
+                for f in (ligand_file, ligand_file[:-6] + '_out.pdbqt'):
+                    if os.path.isfile(f):
+                        os.remove(f)
+        else:
+            rmtree(ligand_dir)
+
+    def _write_ligands(self, ligands, ligand_dir, chunksize=16):
+        """Write ligands to PDBQT files, in parallel processes if requested
+        and there are enough ligands to amortize the cost of spawning them."""
+        for ligand in ligands:
+            check_molecule(ligand, force_coords=True)
+        args = [(ligand, ligand_dir, n) for n, ligand in enumerate(ligands)]
+        n_workers = self._num_workers()
+        if self.parallel_write and len(args) > chunksize and n_workers > 1:
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                return list(executor.map(_write_ligand, args,
+                                         chunksize=chunksize))
+        return list(map(_write_ligand, args))
+
+    def _num_workers(self):
+        """Number of concurrent Vina processes, such that the CPUs requested
+        by all of them (`n_cpu` each) do not exceed the available ones and
+        there are at most `n_jobs` of them."""
+        # do not spawn more processes if already running in a worker pool
+        if multiprocessing.current_process().daemon or self.n_cpu < 1:
+            return 1
+        n_workers = max(1, _available_cpus() // self.n_cpu)
+        if self.n_jobs > 0:
+            n_workers = min(n_workers, self.n_jobs)
+        return n_workers
+
+    def _run_parallel(self, func, ligand_files, receptor_params, params):
+        """Run `func` for every ligand file concurrently. Results are returned
+        in the order of input files, failed ligands are marked with None
+        (if `skip_bad_mols` is set)."""
+        results = [None] * len(ligand_files)
+        # Vina runs as a subprocess, hence threads are sufficient
+        executable = self.executable
+        with ThreadPoolExecutor(max_workers=self._num_workers()) as executor:
+            submit = executor.submit
+            futures = {submit(func, ligand_file, receptor_params, params,
+                              executable): n
+                       for n, ligand_file in enumerate(ligand_files)}
+            for future in as_completed(futures):
+                try:
+                    results[futures[future]] = future.result()
+                except subprocess.CalledProcessError as e:
+                    sys.stderr.write(e.output.decode('ascii'))
+                    if not self.skip_bad_mols:
+                        # do not wait for the remaining ligands to finish
+                        for f in futures:
+                            f.cancel()
+                        raise Exception('Autodock Vina failed. Command: "%s"' %
+                                        ' '.join(e.cmd))
+        return results
+
+    def _dock_batches(self, ligand_files, ligand_dir, as_array=False):
+        """Dock ligand files in chunks, each by a single Autodock Vina (1.2+)
+        run in `--batch` mode, so that receptor is set up once per chunk.
+        Ligands left without poses by failed runs are docked again one by one,
+        to single out the bad molecules."""
+        params = self.params + ['--cpu', str(self.n_cpu)]
+        # spread ligands evenly if there are less of them than workers can take
+        n_workers = self._num_workers()
+        chunk_size = max(1, min(self.batch_size,
+                                -(-len(ligand_files) // n_workers)))
+        chunks = [ligand_files[i:i + chunk_size]
+                  for i in range(0, len(ligand_files), chunk_size)]
+        results = []
+        for chunk_results, error in self._run_parallel(
+                partial(_dock_batch, out_dir=ligand_dir, as_array=as_array),
+                chunks, self.receptor_params, params):
+            results.extend(chunk_results)
+            if error is not None and not self._batch_warned:
+                self._batch_warned = True
+                output = b'\n'.join(error.output.splitlines()[-10:])
+                warnings.warn('Autodock Vina batch run failed (exit code %i), '
+                              'ligands left without poses are docked one by '
+                              'one. Output:\n%s'
+                              % (error.returncode,
+                                 output.decode('ascii', 'replace')))
+
+        failed = [n for n, result in enumerate(results) if result is None]
+        if failed:
+            for n, result in zip(failed, self._run_parallel(
+                    partial(_dock_one, as_array=as_array),
+                    [ligand_files[n] for n in failed],
+                    self.receptor_params, params)):
+                results[n] = result
+        return results
+
+    def _dock_python_api(self, ligand_file, as_array=False):
+        """Dock single ligand file using Vina Python bindings. The receptor and
+        grid maps are set up on first use and reused for following ligands.
+        Returns the path to docked poses and parsed scores."""
+        if self._vina is None:
+            self._vina = vina.Vina(sf_name='vina', cpu=max(self.n_cpu, 0),
+                                   seed=self.seed or 0, verbosity=0)
+            self._vina.set_receptor(self.protein_file)
+            self._vina.compute_vina_maps(center=[float(c) for c in self.center],
+                                         box_size=[float(s) for s in self.size])
+        ligand_outfile = ligand_file[:-6] + '_out.pdbqt'
+        try:
+            self._vina.set_ligand_from_file(ligand_file)
+            self._vina.dock(exhaustiveness=self.exhaustiveness,
+                            n_poses=self.num_modes)
+            self._vina.write_poses(ligand_outfile, n_poses=self.num_modes,
+                                   energy_range=self.energy_range,
+                                   overwrite=True)
+            energies = self._vina.energies(n_poses=self.num_modes,
+                                           energy_range=self.energy_range)
+        except Exception as e:
+            sys.stderr.write('%s\n' % e)
+            if self.skip_bad_mols:
+                return None
+            raise Exception('Autodock Vina failed. Ligand: "%s"' % ligand_file)
+
+        # RMSD bounds are not exposed by bindings, they are stored in poses
+        with open(ligand_outfile) as f:
+            rmsd_bounds = [line.split()[4:6] for line in f
+                           if line[:18] == 'REMARK VINA RESULT']
+        rows = [(energy[0], rmsd_lb, rmsd_ub)
+                for energy, (rmsd_lb, rmsd_ub) in zip(energies, rmsd_bounds)]
+        return ligand_outfile, _docking_scores(rows, as_array=as_array)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # Vina bindings object cannot be pickled, it is recreated on demand
+        state['_vina'] = None
+        return state
+
     def clean(self):
         for d in self.cleanup_dirs:
             rmtree(d)
+        # protein files are gone, they are written again on next use
+        self.cleanup_dirs = set()
+        self._tmp_dir = None
+        self._protein_key = None
+        self._protein_dir = None
 
     def predict_ligand(self, ligand):
         """Local method to score one ligand and update it's scores.
@@ -366,49 +742,306 @@ def write_vina_pdbqt(mol, directory, flexible=True, name_id=None):
     return mol_file
 
 
+def _protein_key(protein):
+    """Identify protein given as a file or a molecule, so that setting up
+    the same protein again can be skipped. Engine holds a reference to the
+    protein molecule, hence its id cannot be recycled."""
+    if isinstance(protein, string_types):
+        return protein, os.path.getmtime(protein)
+    return id(protein), hash(protein.coords.tobytes())
+
+
+def _available_cpus():
+    """Number of CPUs the process is allowed to run on"""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def _version_tuple(version):
+    """Convert version string (e.g. '1.1.2' or 'v1.2.3') to comparable tuple"""
+    return tuple(int(v) for v in re.findall(r'\d+', version))
+
+
+def read_vina_pdbqt_coords(filename):
+    """Read coordinates of all models (docked poses) from PDBQT file without
+    building molecules. Atoms are kept in the order of the file.
+
+    Parameters
+    ----------
+    filename : string
+        Path to PDBQT file, e.g. Autodock Vina output.
+
+    Returns
+    -------
+    poses : list of numpy arrays, shape=[n_atoms, 3]
+        Coordinates of atoms in consecutive models.
+    """
+    poses = []
+    coords = []
+    # whole file is read at once, poses are small and fit in memory
+    with open(filename, 'rb') as f:
+        data = f.read()
+    for line in data.split(b'\n'):
+        if line[:4] == b'ATOM' or line[:6] == b'HETATM':
+            coords.append((float(line[30:38]),
+                           float(line[38:46]),
+                           float(line[46:54])))
+        elif line[:6] == b'ENDMDL':
+            poses.append(np.array(coords))
+            coords = []
+    # single model files have no MODEL/ENDMDL records
+    if coords:
+        poses.append(np.array(coords))
+    return poses
+
+
+def read_vina_pdbqt_scores(filename, as_array=False):
+    """Read scores of all models (docked poses) from `REMARK VINA RESULT`
+    records of Autodock Vina output PDBQT file.
+
+    Parameters
+    ----------
+    filename : string
+        Path to Autodock Vina output PDBQT file.
+
+    as_array : bool (default=False)
+        If True, scores are returned as a structured numpy array, as in
+        `parse_vina_docking_output`.
+
+    Returns
+    -------
+    out : list of dicts or numpy.ndarray
+        dicitionaries containing scores of consecutive poses or a structured
+        array of those scores if `as_array` is True
+    """
+    with open(filename, 'rb') as f:
+        rows = [line.split()[3:6] for line in f
+                if line[:18] == b'REMARK VINA RESULT']
+    return _docking_scores(rows, as_array=as_array)
+
+
+def _symmetry_matches(mol, heavy):
+    """Find all matches of a molecule onto itself, as done by `min_symmetry`
+    method of `oddt.spatial.rmsd`. Returns an array of indices of heavy atoms
+    (given as a mask) for each match."""
+    matches = oddt.toolkit.Smarts(mol).findall(mol, unique=False)
+    if not matches:
+        raise ValueError('Could not find any match between molecules.')
+    matches = np.array(matches, dtype=int)
+    if is_openbabel_molecule(mol):
+        matches -= 1  # OB has 1-based indices
+    return np.array([match[heavy[match]] for match in matches])
+
+
+def _rmsd_input(ref_coords, coords, heavy, matches):
+    """Compute heavy atoms RMSD between pose and input ligand, both directly
+    and minimal over symmetry matches, i.e. `oddt.spatial.rmsd` with
+    `method=None` and `method='min_symmetry'`, in one pass. The latter is None
+    if there are no symmetry matches."""
+    rmsd_direct = np.sqrt(((coords[heavy] - ref_coords)**2).sum(axis=-1).mean())
+    if matches is None:
+        return rmsd_direct, None
+    rmsd_min = np.sqrt(((coords[matches] - ref_coords)**2)
+                       .sum(axis=-1).mean(axis=-1)).min()
+    return rmsd_direct, rmsd_min
+
+
+def _write_ligand(args):
+    """Helper writing flexible ligand to PDBQT, used in process pools."""
+    ligand, directory, name_id = args
+    return write_vina_pdbqt(ligand, directory, name_id=name_id)
+
+
+def _run_vina(cmd, mode, as_array=False):
+    """Run Autodock Vina and parse its output on the fly, without buffering
+    whole STDOUT. Raises `subprocess.CalledProcessError` on failure."""
+    # last lines of output are kept to report errors
+    tail = deque(maxlen=50)
+
+    def lines(stream):
+        for line in stream:
+            tail.append(line)
+            yield line
+
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT) as p:
+        out = _parse_stream(lines(p.stdout), mode, as_array=as_array)
+        retcode = p.wait()
+    if retcode:
+        raise subprocess.CalledProcessError(retcode, cmd, output=b''.join(tail))
+    return out
+
+
+def _score_one(ligand_file, receptor_params, params, executable):
+    """Score single ligand file with Autodock Vina and return parsed scores."""
+    return _run_vina([executable, '--score_only'] + receptor_params +
+                     ['--ligand', ligand_file] + params, 'score')
+
+
+def _dock_one(ligand_file, receptor_params, params, executable,
+              as_array=False):
+    """Dock single ligand file with Autodock Vina. Returns the path to docked
+    poses and parsed scores."""
+    ligand_outfile = ligand_file[:-6] + '_out.pdbqt'
+    scores = _run_vina([executable] + receptor_params +
+                       ['--ligand', ligand_file,
+                        '--out', ligand_outfile] + params, 'dock',
+                       as_array=as_array)
+    return ligand_outfile, scores
+
+
+def _dock_batch(ligand_files, receptor_params, params, executable, out_dir,
+                as_array=False):
+    """Dock multiple ligand files with single Autodock Vina (1.2+) run.
+    Returns the path to docked poses and parsed scores for each ligand file
+    (or None if no poses were written for it) and the error of the run.
+    Scores are read from output files, since STDOUT mixes all ligands.
+
+    Failure of the run is returned as `subprocess.CalledProcessError` instead
+    of being raised, poses written before it are kept and the remaining
+    ligands are expected to be docked again separately."""
+    # Vina names the output after the input file
+    ligand_outfiles = [os.path.join(out_dir, os.path.basename(ligand_file)[:-6]
+                                    + '_out.pdbqt')
+                       for ligand_file in ligand_files]
+    # stale poses (e.g. left in a shared directory by an interrupted run)
+    # must not be taken as results of this run
+    for ligand_outfile in ligand_outfiles:
+        if os.path.isfile(ligand_outfile):
+            os.remove(ligand_outfile)
+    cmd = ([executable] + receptor_params + ['--batch'] + ligand_files +
+           ['--dir', out_dir] + params)
+    p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    error = None
+    if p.returncode:
+        error = subprocess.CalledProcessError(p.returncode, cmd,
+                                              output=p.stdout)
+    results = []
+    for ligand_outfile in ligand_outfiles:
+        if os.path.isfile(ligand_outfile):
+            scores = read_vina_pdbqt_scores(ligand_outfile, as_array=as_array)
+            if len(scores):
+                results.append((ligand_outfile, scores))
+                continue
+        results.append(None)
+    return results, error
+
+
+def _stack_docking_scores(results):
+    """Concatenate per ligand score arrays to a single structured array,
+    annotated with indices of ligands. Failed ligands (None) are skipped."""
+    out = np.empty(sum(len(result[1]) for result in results
+                       if result is not None),
+                   dtype=[('ligand', np.int32)] + VINA_DOCKING_DTYPE.descr)
+    start = 0
+    for i, result in enumerate(results):
+        if result is None:
+            continue
+        scores = result[1]
+        end = start + len(scores)
+        out['ligand'][start:end] = i
+        for name in VINA_DOCKING_DTYPE.names:
+            out[name][start:end] = scores[name]
+        start = end
+    return out
+
+
+def _docking_scores(rows, as_array=False):
+    """Convert rows of affinity, RMSD l.b. and RMSD u.b. (bytes, strings or
+    floats) to a list of dicts or a structured array."""
+    if as_array:
+        # fill one contiguous buffer per column
+        columns = [array('f', map(_fast_float, column))
+                   for column in zip(*rows)] or [array('f')] * 3
+        out = np.empty(len(rows), dtype=VINA_DOCKING_DTYPE)
+        for name, column in zip(VINA_DOCKING_DTYPE.names, columns):
+            out[name] = column
+        return out
+    # Vina versions and sources of scores (STDOUT table, PDBQT remarks)
+    # differ in formatting, hence strings are normalized
+    return [{'vina_affinity': str(round(_fast_float(affinity), 3)),
+             'vina_rmsd_lb': '%.3f' % _fast_float(rmsd_lb),
+             'vina_rmsd_ub': '%.3f' % _fast_float(rmsd_ub)}
+            for affinity, rmsd_lb, rmsd_ub in rows]
+
+
+def _parse_stream(stream, mode, as_array=False):
+    """Parse Autodock Vina output given as an iterable of lines (bytes).
+    Lines are consumed one by one and only those holding scores are decoded,
+    `mode` is either 'score' or 'dock'. Docking scores are returned as
+    a structured array (see `VINA_DOCKING_DTYPE`) if `as_array` is True."""
+    lines = islice(stream, 13, None)  # skip some output
+    if mode == 'score':
+        keys = []
+        values = []
+        for line in lines:
+            # score lines start with 'Affinity:' or 4 spaces
+            if line[:9] == b'Affinity:' or line[:4] == b'    ':
+                m = line.rstrip(b'\r\n').replace(b' ', b'').split(b':')
+                if m[0] == b'Affinity':
+                    m[1] = m[1].replace(b'(kcal/mol)', b'')
+                keys.append('vina_' + m[0].decode('ascii').lower())
+                values.append(m[1])
+        out = dict(zip(keys, map(_fast_float, values)))
+    elif mode == 'dock':
+        rows = []
+        for line in lines:
+            # table rows are indented single digit mode followed by whitespace
+            mode_col = line.lstrip()
+            if (line[:1].isspace() and mode_col[:1].isdigit() and
+                    mode_col[1:2].isspace()):
+                rows.append(line.split()[1:4])
+        out = _docking_scores(rows, as_array=as_array)
+    else:
+        raise ValueError('Unknown Autodock Vina output mode "%s"' % mode)
+    return out
+
+
+def _check_vina_output(output):
+    """Output is parsed as bytes, text would silently match nothing"""
+    if not isinstance(output, bytes):
+        raise TypeError('Autodock Vina output must be bytes, not %s'
+                        % type(output).__name__)
+
+
 def parse_vina_scoring_output(output):
     """Function parsing Autodock Vina scoring output to a dictionary
 
     Parameters
     ----------
-    output : string
-        Autodock Vina standard ouptud (STDOUT).
+    output : bytes
+        Autodock Vina standard ouptud (STDOUT), as returned by
+        `subprocess.check_output`.
 
     Returns
     -------
     out : dict
         dicitionary containing scores computed by Autodock Vina
     """
-    out = {}
-    r = re.compile(r'^(Affinity:|\s{4})')
-    for line in output.decode('ascii').split('\n')[13:]:  # skip some output
-        if r.match(line):
-            m = line.replace(' ', '').split(':')
-            if m[0] == 'Affinity':
-                m[1] = m[1].replace('(kcal/mol)', '')
-            out[str('vina_' + m[0].lower())] = float(m[1])
-    return out
+    _check_vina_output(output)
+    return _parse_stream(output.splitlines(), 'score')
 
 
-def parse_vina_docking_output(output):
+def parse_vina_docking_output(output, as_array=False):
     """Function parsing Autodock Vina docking output to a dictionary
 
     Parameters
     ----------
-    output : string
-        Autodock Vina standard ouptud (STDOUT).
+    output : bytes
+        Autodock Vina standard ouptud (STDOUT), as returned by
+        `subprocess.check_output`.
+
+    as_array : bool (default=False)
+        If True, scores are returned as a structured numpy array with
+        `vina_affinity`, `vina_rmsd_lb` and `vina_rmsd_ub` float fields,
+        one row per pose.
 
     Returns
     -------
-    out : dict
-        dicitionary containing scores computed by Autodock Vina
+    out : list of dicts or numpy.ndarray
+        dicitionaries containing scores computed by Autodock Vina for each
+        pose or a structured array of those scores if `as_array` is True
     """
-    out = []
-    r = re.compile(r'^\s+\d\s+')
-    for line in output.decode('ascii').split('\n')[13:]:  # skip some output
-        if r.match(line):
-            s = line.split()
-            out.append({'vina_affinity': s[1],
-                        'vina_rmsd_lb': s[2],
-                        'vina_rmsd_ub': s[3]})
-    return out
+    _check_vina_output(output)
+    return _parse_stream(output.splitlines(), 'dock', as_array=as_array)
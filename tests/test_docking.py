@@ -0,0 +1,617 @@
+import os
+import stat
+from tempfile import mkdtemp
+
+import numpy as np
+import pytest
+from numpy.testing import assert_array_almost_equal, assert_array_equal
+
+import oddt
+from oddt.docking import autodock_vina, AutodockVina
+from .utils import shuffle_mol
+from oddt.spatial import rmsd
+from oddt.docking.AutodockVina import (parse_vina_scoring_output,
+                                       parse_vina_docking_output,
+                                       read_vina_pdbqt_coords,
+                                       read_vina_pdbqt_scores,
+                                       write_vina_pdbqt,
+                                       VINA_DOCKING_DTYPE,
+                                       _version_tuple,
+                                       _symmetry_matches,
+                                       _rmsd_input,
+                                       _stack_docking_scores)
+
+test_data_dir = os.path.dirname(os.path.abspath(__file__))
+
+# common file names
+dude_data_dir = os.path.join(test_data_dir, 'data', 'dude', 'xiap')
+xiap_crystal_ligand = os.path.join(dude_data_dir, 'crystal_ligand.sdf')
+xiap_protein = os.path.join(dude_data_dir, 'receptor_rdkit.pdb')
+
+# Vina-like executable, which fails on ligands with "bad" in the title and
+# logs all other calls (those take a while, as real docking does). Docking
+# writes the input ligand as a single pose, batch docking stops at the first
+# bad ligand.
+FAKE_VINA = """#!/bin/sh
+case "$*" in
+    *--version*) echo "%s"; exit 0;;
+    *--batch*) ;;
+    *_bad.pdbqt*) echo "Parse error"; exit 1;;
+esac
+echo "$*" >> "$(dirname "$0")/calls.log"
+sleep 0.2
+out=""; dir=""; batch=""; in_batch=0; ligand=""
+while [ $# -gt 0 ]; do
+    case "$1" in
+        --ligand) ligand="$2"; shift;;
+        --out) out="$2"; shift;;
+        --dir) dir="$2"; shift;;
+        --batch) in_batch=1;;
+        --*) in_batch=0;;
+        *) if [ $in_batch = 1 ]; then batch="$batch $1"; fi;;
+    esac
+    shift
+done
+pose() {
+    echo "MODEL 1"
+    echo "REMARK VINA RESULT:    -7.200      0.000      0.000"
+    grep -E "^(ATOM|HETATM)" "$1"
+    echo "ENDMDL"
+}
+if [ -n "$batch" ]; then
+    for ligand in $batch; do
+        case "$ligand" in *_bad.pdbqt) echo "Parse error"; exit 1;; esac
+        pose "$ligand" > "$dir/$(basename "$ligand" .pdbqt)_out.pdbqt"
+    done
+    exit 0
+fi
+i=0
+while [ $i -lt 13 ]; do echo; i=$((i + 1)); done
+if [ -n "$out" ]; then
+    pose "$ligand" > "$out"
+    echo "   1         -7.2          0          0"
+    exit 0
+fi
+echo "Affinity: -3.57594 (kcal/mol)"
+echo "Intramolecular energy: -0.1"
+echo "    gauss1     : 63.01213"
+"""
+
+VINA_HEADER = b"""#################################################################
+# If you used AutoDock Vina in your work, please cite:          #
+#                                                               #
+# O. Trott, A. J. Olson,                                        #
+# AutoDock Vina: improving the speed and accuracy of docking    #
+# with a new scoring function, efficient optimization and       #
+# multithreading, Journal of Computational Chemistry 31 (2010)  #
+# 455-461                                                       #
+#                                                               #
+# DOI 10.1002/jcc.21334                                         #
+#                                                               #
+# Please see http://vina.scripps.edu for more information.      #
+#################################################################
+
+Detected 8 CPUs
+Reading input ... done.
+Setting up the scoring function ... done.
+"""
+
+VINA_SCORING_OUTPUT = VINA_HEADER + b"""Affinity: -3.57594 (kcal/mol)
+Intramolecular contributions to the terms, before weighting:
+    gauss 1     : 63.01213
+    gauss 2     : 999.07625
+    repulsion   : 3.63178
+    hydrophobic : 26.12648
+    Hydrogen    : 0.00000
+"""
+
+VINA_DOCKING_OUTPUT = VINA_HEADER + b"""Analyzing the binding site ... done.
+Using random seed: 42
+Performing search ...
+0%   10   20   30   40   50   60   70   80   90   100%
+|----|----|----|----|----|----|----|----|----|----|
+***************************************************
+done.
+Refining results ... done.
+
+mode |   affinity | dist from best mode
+     | (kcal/mol) | rmsd l.b.| rmsd u.b.
+-----+------------+----------+----------
+   1         -6.3      0.000      0.000
+   2         -6.0      2.054      3.111
+   3         -5.8      1.732      2.399
+Writing output ... done.
+"""
+
+VINA_PDBQT_OUTPUT = """MODEL 1
+REMARK VINA RESULT:      -6.3      0.000      0.000
+REMARK  Name = ligand
+ROOT
+ATOM      2  C   UNL     1       1.000   2.000  -3.000  0.00  0.00    +0.000 C
+HETATM    1  O   UNL     1      -1.500  10.250   0.125  0.00  0.00    -0.300 OA
+ENDROOT
+TORSDOF 0
+ENDMDL
+MODEL 2
+REMARK VINA RESULT:      -6.0      2.054      3.111
+REMARK  Name = ligand
+ROOT
+ATOM      2  C   UNL     1       1.100   2.100  -3.100  0.00  0.00    +0.000 C
+HETATM    1  O   UNL     1      -1.600  10.350   0.225  0.00  0.00    -0.300 OA
+ENDROOT
+TORSDOF 0
+ENDMDL
+"""
+
+# versions reported by fake Vina
+VINA_1_1 = 'AutoDock Vina 1.1.2 (May 11, 2011)'
+VINA_1_2 = 'AutoDock Vina v1.2.5'
+
+skip_no_sh = pytest.mark.skipif(os.name != 'posix',
+                                reason='Fake Vina executable is a shell script')
+
+
+def fake_vina(version=VINA_1_1):
+    """Write fake Vina executable to a temporary directory"""
+    exe = os.path.join(mkdtemp(), 'vina')
+    with open(exe, 'w') as f:
+        f.write(FAKE_VINA % version)
+    os.chmod(exe, os.stat(exe).st_mode | stat.S_IEXEC)
+    return exe
+
+
+def fake_vina_calls(exe):
+    log = os.path.join(os.path.dirname(exe), 'calls.log')
+    if not os.path.isfile(log):
+        return 0
+    with open(log) as f:
+        return len(f.readlines())
+
+
+def ligands_with_bad(n=4):
+    """Copies of XIAP crystal ligand, the first one being "bad" """
+    mol = next(oddt.toolkit.readfile('sdf', xiap_crystal_ligand))
+    ligands = []
+    for i in range(n):
+        ligand = mol.clone
+        ligand.title = 'bad' if i == 0 else 'good'
+        ligands.append(ligand)
+    return ligands
+
+
+@skip_no_sh
+def test_score_skip_bad_mols():
+    """Skip failing ligands during scoring"""
+    exe = fake_vina()
+    engine = autodock_vina(protein=xiap_protein, executable=exe,
+                           prefix_dir=mkdtemp(), skip_bad_mols=True)
+    mols = engine.score(ligands_with_bad())
+    assert len(mols) == 3
+    assert all(mol.title == 'good' for mol in mols)
+    assert float(mols[0].data['vina_affinity']) == -3.57594
+    assert float(mols[0].data['vina_gauss1']) == 63.01213
+    assert fake_vina_calls(exe) == 3
+    engine.clean()
+
+
+@skip_no_sh
+def test_score_raise_bad_mols():
+    """Fail on the first bad ligand, without running the remaining ones"""
+    exe = fake_vina()
+    engine = autodock_vina(protein=xiap_protein, executable=exe,
+                           prefix_dir=mkdtemp(), skip_bad_mols=False,
+                           n_jobs=1)
+    with pytest.raises(Exception, match='Autodock Vina failed'):
+        engine.score(ligands_with_bad(10))
+    # single worker might have picked up next ligand before cancellation
+    assert fake_vina_calls(exe) <= 1
+    engine.clean()
+
+
+@skip_no_sh
+@pytest.mark.skipif(not os.path.isdir('/dev/shm'), reason='No /dev/shm')
+def test_tmpfs_cleanup_on_failure():
+    """Remove in-memory ligand directory also when Vina fails"""
+    exe = fake_vina()
+    engine = autodock_vina(protein=xiap_protein, executable=exe,
+                           prefix_dir=mkdtemp(), skip_bad_mols=False,
+                           ligand_dir_strategy='tmpfs')
+    before = set(os.listdir('/dev/shm'))
+    with pytest.raises(Exception, match='Autodock Vina failed'):
+        engine.score(ligands_with_bad(2))
+    assert set(os.listdir('/dev/shm')) - before == set()
+    engine.clean()
+
+
+def test_parse_vina_output_text():
+    """Vina output is expected as bytes"""
+    with pytest.raises(TypeError):
+        parse_vina_scoring_output('Affinity: -3.57594 (kcal/mol)')
+    with pytest.raises(TypeError):
+        parse_vina_docking_output('   1         -6.3      0.000      0.000')
+
+
+@skip_no_sh
+def test_set_protein_after_clean():
+    """Protein files are written again after cleaning up"""
+    engine = autodock_vina(protein=xiap_protein, executable=fake_vina(),
+                           prefix_dir=mkdtemp())
+    protein_file = engine.protein_file
+    engine.clean()
+    assert not os.path.isfile(protein_file)
+    engine.set_protein(xiap_protein)
+    assert os.path.isfile(engine.protein_file)
+    engine.clean()
+    protein = next(oddt.toolkit.readfile('pdb', xiap_protein))
+    engine.set_protein(protein)
+    assert os.path.isfile(engine.protein_file)
+    engine.clean()
+
+
+@skip_no_sh
+def test_set_protein_repeated():
+    """Protein is written again only if it has changed"""
+    engine = autodock_vina(executable=fake_vina(), prefix_dir=mkdtemp())
+    protein = next(oddt.toolkit.readfile('pdb', xiap_protein))
+    engine.set_protein(protein)
+    protein_file = engine.protein_file
+    engine.set_protein(protein)
+    assert engine.protein_file == protein_file
+
+    engine.set_protein(xiap_protein)
+    assert engine.protein_file != protein_file
+    protein_file = engine.protein_file
+    engine.set_protein(xiap_protein)
+    assert engine.protein_file == protein_file
+
+    # modified protein is written again
+    engine.set_protein(protein)
+    protein_file = engine.protein_file
+    protein.coords = protein.coords + 1.
+    engine.set_protein(protein)
+    assert engine.protein_file != protein_file
+    engine.clean()
+
+
+@skip_no_sh
+def test_maps_opt_in():
+    """Grid maps are precomputed only if requested"""
+    engine = autodock_vina(protein=xiap_protein, executable=fake_vina(VINA_1_2),
+                           prefix_dir=mkdtemp())
+    assert engine.maps_prefix is None
+    assert engine.receptor_params == ['--receptor', engine.protein_file]
+    engine.clean()
+
+    engine = autodock_vina(protein=xiap_protein, executable=fake_vina(VINA_1_2),
+                           prefix_dir=mkdtemp(), use_maps=True)
+    assert engine.receptor_params == ['--maps', engine.maps_prefix]
+    engine.clean()
+
+    # not supported by Vina 1.1.2
+    engine = autodock_vina(protein=xiap_protein, executable=fake_vina(),
+                           prefix_dir=mkdtemp(), use_maps=True)
+    assert engine.maps_prefix is None
+    engine.clean()
+
+
+@skip_no_sh
+def test_dock_batch_failure():
+    """Only ligands without poses from failed batch are docked again"""
+    exe = fake_vina(VINA_1_2)
+    engine = autodock_vina(protein=xiap_protein, executable=exe,
+                           prefix_dir=mkdtemp(), n_jobs=1)
+    ligands = ligands_with_bad(4)
+    ligands[0], ligands[1] = ligands[1], ligands[0]
+    with pytest.warns(UserWarning, match='batch run failed') as record:
+        scores = engine.dock(ligands, poses=False)
+        engine.dock(ligands, poses=False)
+    # warned once, with the output of Vina
+    assert len(record) == 1
+    assert 'Parse error' in str(record[0].message)
+    assert scores['ligand'].tolist() == [0, 2, 3]
+    assert_array_almost_equal(scores['vina_affinity'], [-7.2] * 3)
+    # single batch and separate runs for the two ligands following bad one
+    assert fake_vina_calls(exe) == 6
+    engine.clean()
+
+
+@skip_no_sh
+def test_shared_ligand_dir():
+    """Shared ligand directory is reused, cleaned and ignores stale poses"""
+    exe = fake_vina(VINA_1_2)
+    engine = autodock_vina(protein=xiap_protein, executable=exe,
+                           prefix_dir=mkdtemp(), n_jobs=1,
+                           ligand_dir_strategy='shared')
+    ligand_dir = os.path.join(engine.tmp_dir, 'ligands_%i' % os.getpid())
+    os.makedirs(ligand_dir)
+    # pose left by an interrupted run for the ligand which fails now
+    with open(os.path.join(ligand_dir, '0_bad_out.pdbqt'), 'w') as f:
+        f.write(VINA_PDBQT_OUTPUT)
+
+    ligands = ligands_with_bad(4)
+    with pytest.warns(UserWarning, match='batch run failed'):
+        scores = engine.dock(ligands, poses=False)
+    assert scores['ligand'].tolist() == [1, 2, 3]
+    assert os.listdir(ligand_dir) == []
+
+    assert len(engine.score(ligands[1:])) == 3
+    assert len(engine.dock(ligands[1:])) == 3
+    assert [d for d in os.listdir(engine.tmp_dir)
+            if d.startswith('ligands_')] == [os.path.basename(ligand_dir)]
+    assert os.listdir(ligand_dir) == []
+    engine.clean()
+
+
+def test_docking_scores_format():
+    """Scores from STDOUT and output PDBQT are formatted the same way"""
+    output = b'\n' * 13 + (b'   1       -7.282          0          0\n'
+                            b'   2         -6.9      2.033      5.447\n')
+    pdbqt = os.path.join(mkdtemp(), 'ligand_out.pdbqt')
+    with open(pdbqt, 'w') as f:
+        f.write('MODEL 1\n'
+                'REMARK VINA RESULT:    -7.282      0.000      0.000\n'
+                'ENDMDL\n'
+                'MODEL 2\n'
+                'REMARK VINA RESULT:    -6.900      2.033      5.447\n'
+                'ENDMDL\n')
+    scores = [{'vina_affinity': '-7.282',
+               'vina_rmsd_lb': '0.000',
+               'vina_rmsd_ub': '0.000'},
+              {'vina_affinity': '-6.9',
+               'vina_rmsd_lb': '2.033',
+               'vina_rmsd_ub': '5.447'}]
+    assert parse_vina_docking_output(output) == scores
+    assert read_vina_pdbqt_scores(pdbqt) == scores
+
+
+@pytest.mark.skipif(AutodockVina.vina is None,
+                    reason='Autodock Vina Python bindings not installed')
+def test_python_api_without_executable(monkeypatch):
+    """Dock using Vina Python bindings only"""
+    monkeypatch.delitem(autodock_vina._exe_cache, 'vina', raising=False)
+    monkeypatch.setattr(AutodockVina, 'find_executable', lambda name: None)
+    engine = autodock_vina(protein=xiap_protein,
+                           auto_ligand=xiap_crystal_ligand,
+                           prefix_dir=mkdtemp(), use_python_api=True,
+                           exhaustiveness=1, num_modes=3, seed=0)
+    assert engine.executable is None
+    assert engine.version == AutodockVina.vina.__version__
+
+    ligand = next(oddt.toolkit.readfile('sdf', xiap_crystal_ligand))
+    with pytest.raises(Exception, match='binary is required'):
+        engine.score([ligand])
+    mols = engine.dock([ligand])
+    assert 1 <= len(mols) <= 3
+    for mol in mols:
+        affinity = mol.data['vina_affinity']
+        assert affinity == str(round(float(affinity), 3))
+        assert len(mol.data['vina_rmsd_lb'].split('.')[1]) == 3
+    engine.clean()
+
+
+@skip_no_sh
+@pytest.mark.parametrize('version', [VINA_1_1, VINA_1_2])
+def test_dock_atom_order(version, monkeypatch):
+    """Atoms of docked poses match the input ligand with hydrogens"""
+    # symmetry is not searched for poses identical to the input
+    def symmetry_matches(mol, heavy):
+        raise AssertionError('Symmetry searched for input pose')
+    monkeypatch.setattr(AutodockVina, '_symmetry_matches', symmetry_matches)
+    engine = autodock_vina(protein=xiap_protein, executable=fake_vina(version),
+                           prefix_dir=mkdtemp())
+    ligand = next(oddt.toolkit.readfile('sdf', xiap_crystal_ligand))
+    ligand.addh()
+    ligand = shuffle_mol(ligand)
+    assert (ligand.atom_dict['atomicnum'] == 1).any()
+
+    # fake Vina returns the input ligand as docked pose
+    mols = engine.dock([ligand])
+    assert len(mols) == 1
+    assert_array_equal(mols[0].atom_dict['atomicnum'],
+                       ligand.atom_dict['atomicnum'])
+    assert_array_almost_equal(mols[0].coords, ligand.coords, decimal=3)
+    assert float(mols[0].data['vina_rmsd_input']) == 0.
+    assert float(mols[0].data['vina_rmsd_input_min']) == 0.
+    engine.clean()
+
+
+def test_parse_vina_scoring_output():
+    """Parse captured Vina scoring output"""
+    assert parse_vina_scoring_output(VINA_SCORING_OUTPUT) == {
+        'vina_affinity': -3.57594,
+        'vina_gauss1': 63.01213,
+        'vina_gauss2': 999.07625,
+        'vina_repulsion': 3.63178,
+        'vina_hydrophobic': 26.12648,
+        'vina_hydrogen': 0.,
+    }
+
+
+def test_parse_vina_docking_output():
+    """Parse captured Vina docking output to dicts and array"""
+    scores = parse_vina_docking_output(VINA_DOCKING_OUTPUT)
+    assert scores == [
+        {'vina_affinity': '-6.3', 'vina_rmsd_lb': '0.000', 'vina_rmsd_ub': '0.000'},
+        {'vina_affinity': '-6.0', 'vina_rmsd_lb': '2.054', 'vina_rmsd_ub': '3.111'},
+        {'vina_affinity': '-5.8', 'vina_rmsd_lb': '1.732', 'vina_rmsd_ub': '2.399'},
+    ]
+
+    scores_array = parse_vina_docking_output(VINA_DOCKING_OUTPUT, as_array=True)
+    assert scores_array.dtype == VINA_DOCKING_DTYPE
+    assert len(scores_array) == 3
+    for name in VINA_DOCKING_DTYPE.names:
+        assert_array_almost_equal(scores_array[name],
+                                  [float(score[name]) for score in scores])
+
+    empty = parse_vina_docking_output(VINA_HEADER, as_array=True)
+    assert empty.dtype == VINA_DOCKING_DTYPE
+    assert len(empty) == 0
+    assert parse_vina_docking_output(VINA_HEADER) == []
+
+
+def test_read_vina_pdbqt():
+    """Read coordinates and scores of poses from Vina output"""
+    pdbqt = os.path.join(mkdtemp(), 'ligand_out.pdbqt')
+    with open(pdbqt, 'w') as f:
+        f.write(VINA_PDBQT_OUTPUT)
+
+    poses = read_vina_pdbqt_coords(pdbqt)
+    assert len(poses) == 2
+    # atoms are kept in the order of the file
+    assert_array_almost_equal(poses[0], [[1., 2., -3.], [-1.5, 10.25, 0.125]])
+    assert_array_almost_equal(poses[1], [[1.1, 2.1, -3.1], [-1.6, 10.35, 0.225]])
+
+    assert read_vina_pdbqt_scores(pdbqt) == [
+        {'vina_affinity': '-6.3', 'vina_rmsd_lb': '0.000', 'vina_rmsd_ub': '0.000'},
+        {'vina_affinity': '-6.0', 'vina_rmsd_lb': '2.054', 'vina_rmsd_ub': '3.111'},
+    ]
+    scores = read_vina_pdbqt_scores(pdbqt, as_array=True)
+    assert scores.dtype == VINA_DOCKING_DTYPE
+    assert_array_almost_equal(scores['vina_affinity'], [-6.3, -6.])
+
+    # single model without MODEL records
+    with open(pdbqt, 'w') as f:
+        f.write('\n'.join(line for line in VINA_PDBQT_OUTPUT.splitlines()[:8]
+                          if not line.startswith('MODEL')))
+    poses = read_vina_pdbqt_coords(pdbqt)
+    assert len(poses) == 1
+    assert poses[0].shape == (2, 3)
+
+
+def test_version_tuple():
+    """Compare Vina versions"""
+    assert _version_tuple('1.1.2') == (1, 1, 2)
+    assert _version_tuple('v1.2.5') == (1, 2, 5)
+    assert _version_tuple('1.1.2') < (1, 2)
+    assert _version_tuple('v1.2.0') >= (1, 2)
+
+
+def test_rmsd_input():
+    """RMSD to input pose matches oddt.spatial.rmsd"""
+    np.random.seed(42)
+    ligand = next(oddt.toolkit.readfile('sdf', xiap_crystal_ligand))
+    heavy = ligand.atom_dict['atomicnum'] != 1
+    matches = _symmetry_matches(ligand, heavy)
+    for _ in range(5):
+        pose = ligand.clone
+        pose.coords = ligand.coords + np.random.normal(
+            scale=1., size=(len(ligand.atoms), 3))
+        rmsd_direct, rmsd_min = _rmsd_input(ligand.coords[heavy], pose.coords,
+                                            heavy, matches)
+        assert_array_almost_equal(rmsd_direct, rmsd(ligand, pose), decimal=4)
+        assert_array_almost_equal(rmsd_min, rmsd(ligand, pose,
+                                                 method='min_symmetry'),
+                                  decimal=4)
+        assert rmsd_min <= rmsd_direct
+    rmsd_direct, rmsd_min = _rmsd_input(ligand.coords[heavy], pose.coords,
+                                        heavy, None)
+    assert_array_almost_equal(rmsd_direct, rmsd(ligand, pose), decimal=4)
+    assert rmsd_min is None
+
+
+def test_stack_docking_scores():
+    """Concatenate scores of docked ligands, skipping failed ones"""
+    first = parse_vina_docking_output(VINA_DOCKING_OUTPUT, as_array=True)
+    second = first[:2]
+    scores = _stack_docking_scores([None, ('1_out.pdbqt', first), None,
+                                    ('3_out.pdbqt', second)])
+    assert scores.dtype.names == ('ligand',) + VINA_DOCKING_DTYPE.names
+    assert_array_equal(scores['ligand'], [1, 1, 1, 3, 3])
+    assert_array_almost_equal(scores['vina_affinity'],
+                              [-6.3, -6., -5.8, -6.3, -6.])
+
+    scores = _stack_docking_scores([None, None])
+    assert len(scores) == 0
+    assert scores.dtype.names == ('ligand',) + VINA_DOCKING_DTYPE.names
+
+
+def test_num_workers(monkeypatch):
+    """Concurrent Vina runs are limited by available CPUs and n_jobs"""
+    monkeypatch.setattr(AutodockVina, '_available_cpus', lambda: 8)
+    engine = autodock_vina.__new__(autodock_vina)
+    for n_cpu, n_jobs, n_workers in [(1, -1, 8), (2, -1, 4), (16, -1, 1),
+                                     (1, 1, 1), (1, 3, 3), (2, 16, 4)]:
+        engine.n_cpu = n_cpu
+        engine.n_jobs = n_jobs
+        assert engine._num_workers() == n_workers
+
+
+@skip_no_sh
+def test_set_protein_removes_previous():
+    """Files of previous protein are removed, user PDBQT files are kept"""
+    engine = autodock_vina(executable=fake_vina(VINA_1_2), prefix_dir=mkdtemp(),
+                           use_maps=True)
+    protein = next(oddt.toolkit.readfile('pdb', xiap_protein))
+    receptors = [xiap_protein, protein, xiap_protein]
+    pdbqt = None
+    if oddt.toolkit.backend == 'ob':
+        # RDKit cannot read protein PDBQT files
+        pdbqt = write_vina_pdbqt(protein, mkdtemp(), flexible=False)
+        receptors += [pdbqt, protein]
+    for receptor in receptors:
+        engine.set_protein(receptor)
+        protein_dirs = [d for d in os.listdir(engine.tmp_dir)
+                        if d.startswith('protein_')]
+        assert len(protein_dirs) == 1
+        assert os.path.isfile(engine.protein_file)
+        if receptor is pdbqt:
+            assert engine.protein_file == pdbqt
+    if pdbqt:
+        assert os.path.isfile(pdbqt)
+    engine.clean()
+
+
+@skip_no_sh
+def test_batch_only_vina():
+    """Batch docking and grid maps are not used with Vina compatible software"""
+    exe = fake_vina('QuickVina 2.1 (24 Dec, 2017)')
+    engine = autodock_vina(protein=xiap_protein, executable=exe,
+                           prefix_dir=mkdtemp(), use_maps=True)
+    assert engine.maps_prefix is None
+    scores = engine.dock(ligands_with_bad(3)[1:], poses=False)
+    assert scores['ligand'].tolist() == [0, 1]
+    with open(os.path.join(os.path.dirname(exe), 'calls.log')) as f:
+        calls = f.read()
+    assert '--batch' not in calls
+    assert '--write_maps' not in calls
+    engine.clean()
+
+
+@skip_no_sh
+def test_parallel_write(monkeypatch):
+    """Ligands written in parallel processes keep their order"""
+    monkeypatch.setattr(AutodockVina, '_available_cpus', lambda: 4)
+    pools = []
+
+    class Executor(AutodockVina.ProcessPoolExecutor):
+        def __init__(self, *args, **kwargs):
+            pools.append(kwargs)
+            super(Executor, self).__init__(*args, **kwargs)
+    monkeypatch.setattr(AutodockVina, 'ProcessPoolExecutor', Executor)
+
+    engine = autodock_vina(protein=xiap_protein, executable=fake_vina(),
+                           prefix_dir=mkdtemp(), parallel_write=True,
+                           n_jobs=2)
+    mol = next(oddt.toolkit.readfile('sdf', xiap_crystal_ligand))
+    ligands = []
+    for i in range(20):
+        ligand = mol.clone
+        ligand.title = 'ligand_%i' % i
+        ligand.coords = mol.coords + i
+        ligands.append(ligand)
+
+    ligand_dir = mkdtemp()
+    ligand_files = engine._write_ligands(ligands, ligand_dir)
+    assert pools == [{'max_workers': 2}]
+    assert ([os.path.basename(f) for f in ligand_files] ==
+            ['%i_ligand_%i.pdbqt' % (i, i) for i in range(20)])
+    assert sorted(os.listdir(ligand_dir)) == sorted(
+        os.path.basename(f) for f in ligand_files)
+
+    # fake Vina returns the input ligand as docked pose
+    mols = engine.dock(ligands)
+    assert len(pools) == 2
+    assert len(mols) == len(ligands)
+    for docked, ligand in zip(mols, ligands):
+        assert_array_almost_equal(docked.coords, ligand.coords, decimal=3)
+    engine.clean()